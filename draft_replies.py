@@ -1,21 +1,34 @@
 #!/usr/bin/env python3
 import os
+import re
 import base64
-import json
-import time
+import asyncio
 import logging
+import hashlib
+import functools
+from collections import defaultdict
+from email.utils import parseaddr
 from datetime import datetime, timezone
+from diskcache import Cache
 from dotenv import load_dotenv
-import openai
+import httpx
+import orjson
+from openai import (
+    AsyncOpenAI, BadRequestError, DefaultAsyncHttpxClient, NOT_GIVEN, NotFoundError
+)
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.errors import HttpError
+from gmail_batch import (
+    BATCH_SIZE, build_service, chunked, fetch_messages, is_retryable, run_gmail
+)
+from email_text import PART_FIELDS, extract_body
 
 # ─── CONFIGURATION ─────────────────────────────────────────────────────────────
 load_dotenv()
 OPENAI_API_KEY       = os.getenv('OPENAI_API_KEY')
 ASSISTANT_ID         = os.getenv('ASSISTANT_ID')
+VECTOR_STORE_ID      = os.getenv('VECTOR_STORE_ID')
 SIGNATURE            = os.getenv(
     'EMAIL_SIGNATURE',
     "-- \nEric Rosenberg\nEricRosenberg.com\nFinancial Writing, Speaking, and Consulting"
@@ -23,8 +36,39 @@ SIGNATURE            = os.getenv(
 SCOPES               = ['https://www.googleapis.com/auth/gmail.modify']
 CREDENTIALS_PATH     = os.getenv('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
 LAST_RUN_FILE        = 'last_run.json'
+CONVERSATIONS_FILE   = 'conversations.json'
+# A sender's reply chain restarts after this many replies or this much time,
+# which bounds the context (and input tokens) carried into each reply
+CONVERSATION_TURNS   = 10
+CONVERSATION_MAX_AGE = 30 * 24 * 3600  # seconds
+LIST_PAGE_SIZE       = 500  # Gmail's maximum page size for messages.list
+MODIFY_BATCH_SIZE    = 1000  # messages.batchModify accepts up to 1000 IDs
+# Auto-generated mail is skipped before it reaches OpenAI
+AUTO_PRECEDENCE      = frozenset(('bulk', 'list', 'junk', 'auto_reply'))
+AUTO_SUBJECT_RE      = re.compile(
+    r'^\s*(out of (the )?office|automatic reply|auto(matic)?[- ]?reply'
+    r'|undeliverable|delivery status notification|mail delivery failed)',
+    re.IGNORECASE
+)
+AUTO_SENDER_RE       = re.compile(r'\b(mailer-daemon|postmaster)@', re.IGNORECASE)
+# Partial response: only the parts of the message resource we actually read
+MESSAGE_FIELDS       = f'threadId,payload({PART_FIELDS})'
+OPENAI_CONCURRENCY   = int(os.getenv('OPENAI_CONCURRENCY', '20'))
+HTTP_MAX_CONNECTIONS = 50  # pooled HTTP/2 connections to OpenAI
+REPLY_CACHE_DIR      = os.getenv('REPLY_CACHE_DIR', '.reply_cache')
+REPLY_CACHE_TTL      = 30 * 24 * 3600  # seconds
+REPLY_CACHE_SIZE     = 64 * 1024 * 1024  # bytes
 
-openai.api_key = OPENAI_API_KEY
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=DefaultAsyncHttpxClient(
+        http2=True, limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS)
+    )
+)
+# One lock per sender so replies in a sender's conversation never overlap
+_sender_locks = defaultdict(asyncio.Lock)
+# Task fetching the Responses API settings, started by the first reply
+_response_settings = None
 
 # ─── LOGGING SETUP ──────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -34,11 +78,17 @@ logging.basicConfig(
 )
 
 # ─── GMAIL / OPENAI HELPERS ────────────────────────────────────────────────────
+@functools.lru_cache(maxsize=1)
 def get_service():
     """Authenticate (or load token.json) and return a Gmail API service."""
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        # Refresh up front rather than on the first API call
+        if creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+            with open('token.json', 'w') as f:
+                f.write(creds.to_json())
     else:
         flow = InstalledAppFlow.from_client_secrets_file(
             CREDENTIALS_PATH, SCOPES
@@ -50,67 +100,110 @@ def get_service():
         creds = flow.credentials
         with open('token.json', 'w') as f:
             f.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    return build_service(creds)
 
 def get_last_run_time():
     """Load last run ISO timestamp or return None."""
     if os.path.exists(LAST_RUN_FILE):
-        with open(LAST_RUN_FILE) as f:
-            return json.load(f).get('last_run')
+        with open(LAST_RUN_FILE, 'rb') as f:
+            return orjson.loads(f.read()).get('last_run')
     return None
 
 def update_last_run_time():
     """Write the current UTC time to LAST_RUN_FILE."""
     now = datetime.now(timezone.utc).isoformat()
-    with open(LAST_RUN_FILE, 'w') as f:
-        json.dump({'last_run': now}, f)
+    with open(LAST_RUN_FILE, 'wb') as f:
+        f.write(orjson.dumps({'last_run': now}))
+
+def load_conversations():
+    """Load the sender -> reply chain map, or return an empty dict."""
+    if os.path.exists(CONVERSATIONS_FILE):
+        with open(CONVERSATIONS_FILE, 'rb') as f:
+            return orjson.loads(f.read())
+    return {}
+
+def is_live_chain(chain, now):
+    """
+    Return True if a sender's reply chain can be continued at epoch time `now`.
+    Entries from older versions were bare response IDs; those start over.
+    """
+    return (isinstance(chain, dict)
+            and chain['turns'] < CONVERSATION_TURNS
+            and now - chain['started'] <= CONVERSATION_MAX_AGE)
+
+def save_conversations(conversations):
+    """
+    Write the sender -> reply chain map to CONVERSATIONS_FILE, dropping chains
+    that would start over anyway so the file does not grow without bound.
+    """
+    now = datetime.now(timezone.utc).timestamp()
+    live = {key: chain for key, chain in conversations.items() if is_live_chain(chain, now)}
+    with open(CONVERSATIONS_FILE, 'wb') as f:
+        f.write(orjson.dumps(live))
 
 def get_unread_messages(service, last_run):
     """
-    Return all messages matching "in:inbox is:unread [after:TIMESTAMP]" via pagination.
+    Yield messages matching "in:inbox is:unread [after:TIMESTAMP]" as each page arrives.
+    Listing errors propagate so the caller can tell a partial listing apart
+    from the end of the list.
     """
     query = 'in:inbox is:unread'
     if last_run:
         ts = int(datetime.fromisoformat(last_run).timestamp())
         query += f' after:{ts}'
-    messages = []
-    try:
-        request = service.users().messages().list(userId='me', q=query)
-        while request:
-            resp = request.execute()
-            messages.extend(resp.get('messages', []))
-            request = service.users().messages().list_next(request, resp)
-    except HttpError as e:
-        logging.error('Gmail list error: %s', e)
-    return messages
-
-def get_message_content(service, msg_id):
-    """
-    Fetch the full message, extract subject, sender, text/plain or fallback to HTML.
-    Returns (subject, sender, body, thread_id).
-    """
-    resp = service.users().messages().get(
-        userId='me', id=msg_id, format='full'
-    ).execute()
+    request = service.users().messages().list(
+        userId='me', q=query, maxResults=LIST_PAGE_SIZE
+    )
+    while request:
+        resp = request.execute()
+        yield from resp.get('messages', [])
+        request = service.users().messages().list_next(request, resp)
+
+def is_auto_reply(hdr, subject, sender):
+    """
+    Return True for out-of-office replies, bounces and bulk mail, judged by
+    the lower-cased header dict `hdr`, the subject and the sender.
+    """
+    if hdr.get('auto-submitted', 'no').strip().lower() != 'no':
+        return True
+    if hdr.get('precedence', '').strip().lower() in AUTO_PRECEDENCE:
+        return True
+    if 'x-autoreply' in hdr or 'x-autorespond' in hdr:
+        return True
+    return bool(AUTO_SUBJECT_RE.match(subject) or AUTO_SENDER_RE.search(sender))
+
+def parse_message(resp):
+    """
+    Extract subject, sender, text/plain or fallback to HTML from a full message.
+    Returns (subject, sender, body, thread_id, auto_reply); the body is left
+    empty for auto-replies since they are never drafted.
+    """
     payload = resp.get('payload', {})
-    headers = payload.get('headers', [])
-    subject = next((h['value'] for h in headers if h['name']=='Subject'), '(no subject)')
-    sender  = next((h['value'] for h in headers if h['name']=='From'), '(unknown)')
-    # extract body
-    body = ''
-    for part in payload.get('parts', []):
-        if part.get('mimeType')=='text/plain' and part.get('body',{}).get('data'):
-            body = base64.urlsafe_b64decode(part['body']['data']).decode()
-            break
-    if not body:
-        for part in payload.get('parts', []):
-            if part.get('mimeType')=='text/html' and part.get('body',{}).get('data'):
-                html = base64.urlsafe_b64decode(part['body']['data']).decode()
-                body = html.replace('<br>', '\n').replace('<br/>', '\n')
-                break
-    if not body and payload.get('body',{}).get('data'):
-        body = base64.urlsafe_b64decode(payload['body']['data']).decode()
-    return subject, sender, body, resp.get('threadId')
+    # header names are case-insensitive, so key them lower-cased
+    hdr     = {h['name'].lower(): h['value'] for h in payload.get('headers', [])}
+    subject = hdr.get('subject', '(no subject)')
+    sender  = hdr.get('from', '(unknown)')
+    if is_auto_reply(hdr, subject, sender):
+        return subject, sender, '', resp.get('threadId'), True
+    body    = extract_body(payload)
+    return subject, sender, body, resp.get('threadId'), False
+
+def get_message_contents(service, messages):
+    """
+    Fetch and parse full messages via gmail_batch.fetch_messages.
+    Returns a dict mapping each msg_id to its parse_message tuple, or to the
+    exception raised while fetching or parsing that message.
+    """
+    return fetch_messages(
+        service, [msg['id'] for msg in messages], MESSAGE_FIELDS, parse_message
+    )
+
+def mark_read(service, msg_ids):
+    """Remove the UNREAD label from the given messages via batchModify."""
+    for chunk in chunked(msg_ids, MODIFY_BATCH_SIZE):
+        service.users().messages().batchModify(
+            userId='me', body={'ids': chunk, 'removeLabelIds': ['UNREAD']}
+        ).execute()
 
 def draft_reply(service, thread_id, to_email, subject, text):
     """
@@ -123,75 +216,234 @@ def draft_reply(service, thread_id, to_email, subject, text):
     body = {'message': {'threadId': thread_id, 'raw': raw, 'labelIds': ['DRAFT']}}
     service.users().drafts().create(userId='me', body=body).execute()
 
-def generate_reply_from_openai(user_msg):
+def sender_key(sender):
+    """Return the normalized address used to key per-sender state."""
+    return parseaddr(sender)[1].lower() or sender
+
+@functools.lru_cache(maxsize=1)
+def get_reply_cache():
     """
-    Send the user message to your Assistant and wait for completion.
+    Open the cache of completed replies, keyed by sender and body, so re-seen
+    messages skip OpenAI. Opened on first use so imports create no files.
     """
-    thread = openai.beta.threads.create()
-    openai.beta.threads.messages.create(
-        thread_id=thread.id, role='user', content=user_msg
+    return Cache(
+        REPLY_CACHE_DIR, size_limit=REPLY_CACHE_SIZE,
+        eviction_policy='least-recently-used'
     )
-    run = openai.beta.threads.runs.create(
-        thread_id=thread.id, assistant_id=ASSISTANT_ID
-    )
-    while run.status not in ('completed','failed'):
-        time.sleep(2)
-        run = openai.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-    if run.status!='completed':
-        raise RuntimeError('OpenAI run failed')
-    msgs = openai.beta.threads.messages.list(thread_id=thread.id)
-    return msgs.data[0].content[0].text.value
+
+def reply_cache_key(body, sender):
+    """
+    Return the reply cache key for a message body from a sender. The sender is
+    part of the key because each sender's replies draw on their own history.
+    """
+    data = f'{sender_key(sender)}\0{body}'.encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+async def fetch_response_settings():
+    """
+    Read the model, instructions and vector store from the configured Assistant
+    and return them as Responses API arguments. VECTOR_STORE_ID, if set,
+    overrides the Assistant's own vector stores.
+    """
+    assistant = await client.beta.assistants.retrieve(ASSISTANT_ID)
+    settings = {'model': assistant.model, 'instructions': assistant.instructions}
+    if assistant.temperature is not None:
+        settings['temperature'] = assistant.temperature
+    if assistant.top_p is not None:
+        settings['top_p'] = assistant.top_p
+
+    if VECTOR_STORE_ID:
+        vector_store_ids = [VECTOR_STORE_ID]
+    else:
+        resources = assistant.tool_resources
+        file_search = resources.file_search if resources else None
+        vector_store_ids = (file_search.vector_store_ids if file_search else None) or []
+    if vector_store_ids:
+        settings['tools'] = [
+            {'type': 'file_search', 'vector_store_ids': vector_store_ids}
+        ]
+    return settings
+
+async def get_response_settings():
+    """
+    Return the Responses API settings, fetching them on first use so runs with
+    nothing to reply to never call the Assistants API. Concurrent callers
+    share one fetch; if it fails, each caller sees the error.
+    """
+    global _response_settings
+    if _response_settings is None:
+        _response_settings = asyncio.ensure_future(fetch_response_settings())
+    return await _response_settings
+
+async def generate_reply_from_openai(user_msg, sender, conversations, sem):
+    """
+    Generate a reply with a single Responses API call.
+    Each sender's replies are chained with previous_response_id, recorded in
+    `conversations` as {'id', 'turns', 'started'}; a chain that has reached
+    CONVERSATION_TURNS replies or CONVERSATION_MAX_AGE starts over.
+    The sender's lock is taken before a `sem` slot, so messages queued behind
+    the same sender never hold slots other senders could use.
+    """
+    settings = await get_response_settings()
+    key = sender_key(sender)
+    async with _sender_locks[key], sem:
+        now = datetime.now(timezone.utc).timestamp()
+        chain = conversations.get(key)
+        if not is_live_chain(chain, now):
+            chain = None
+        previous_id = chain['id'] if chain else None
+        try:
+            resp = await client.responses.create(
+                input=user_msg, previous_response_id=previous_id or NOT_GIVEN,
+                truncation='auto', **settings
+            )
+        except (NotFoundError, BadRequestError):
+            if not previous_id:
+                raise
+            logging.warning('Response %s for %s is gone, starting over', previous_id, key)
+            chain = None
+            resp = await client.responses.create(
+                input=user_msg, truncation='auto', **settings
+            )
+        if resp.status!='completed':
+            raise RuntimeError(f'OpenAI response {resp.status}')
+        conversations[key] = {
+            'id': resp.id,
+            'turns': chain['turns'] + 1 if chain else 1,
+            'started': chain['started'] if chain else now
+        }
+        return resp.output_text
+
+async def process_message(service, msg_id, content, sem, conversations):
+    """
+    Draft a reply for a single fetched message.
+    `content` is the parsed message, or the exception raised fetching it.
+    `conversations` and `sem`, which caps the OpenAI requests in flight, are
+    passed through to generate_reply_from_openai.
+    Returns:
+      1 if a draft was created,
+      0 if skipped (auto-reply or empty body),
+     -1 on error,
+     -2 if fetching the message kept failing with a transient error.
+    """
+    if isinstance(content, Exception) and is_retryable(content):
+        logging.error('Could not fetch %s, will retry next run: %s', msg_id, content)
+        return -2
+    try:
+        if content is None:
+            raise RuntimeError('message was not fetched')
+        if isinstance(content, Exception):
+            raise content
+        subj, sender, body, thread_id, auto_reply = content
+        if auto_reply:
+            logging.info('Skipped auto-reply %s (%s)', msg_id, subj)
+            return 0
+        if not body.strip():
+            logging.warning('Skipped empty message %s', msg_id)
+            return 0
+
+        logging.info('Drafting reply for %s (from %s)', subj, sender)
+        key = reply_cache_key(body, sender)
+        reply_cache = get_reply_cache()
+        reply = reply_cache.get(key)
+        if reply is None:
+            reply = await generate_reply_from_openai(body, sender, conversations, sem)
+            reply_cache.set(key, reply, expire=REPLY_CACHE_TTL)
+        else:
+            logging.info('Using cached reply for %s', msg_id)
+        await run_gmail(draft_reply, service, thread_id, sender, subj, reply)
+        logging.info('Draft created for %s', msg_id)
+        return 1
+
+    except Exception as e:
+        logging.error('Error on %s: %s', msg_id, e)
+        return -1
+
+async def draft_chunk(service, chunk, sem, conversations, drafted_ids):
+    """
+    Batch-fetch a chunk of messages and draft replies for them concurrently.
+    Each message is appended to `drafted_ids` as soon as its draft exists.
+    Returns the process_message results in chunk order.
+    """
+    try:
+        contents = await run_gmail(get_message_contents, service, chunk, fetch=True)
+    except Exception as e:
+        logging.error('Gmail batch fetch error: %s', e)
+        contents = {}
+
+    async def draft(msg):
+        result = await process_message(
+            service, msg['id'], contents.get(msg['id']), sem, conversations
+        )
+        if result == 1:
+            drafted_ids.append(msg['id'])
+        return result
+
+    return await asyncio.gather(*(draft(msg) for msg in chunk))
 
 # ─── MAIN ──────────────────────────────────────────────────────────────────────
-def main():
+async def main():
     service     = get_service()
     last_run    = get_last_run_time()
-    messages    = get_unread_messages(service, last_run)
+    sem         = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    conversations = load_conversations()
+
+    # Pipeline: fetch and draft each chunk while later pages load
+    chunks      = chunked(get_unread_messages(service, last_run), BATCH_SIZE)
+    messages    = []
+    tasks       = []
+    drafted_ids = []
+    list_failed = False
+    try:
+        while True:
+            try:
+                chunk = await run_gmail(next, chunks, None)
+            except Exception as e:
+                # Still draft what was listed, but keep last_run where it is
+                logging.error('Gmail list error: %s', e)
+                list_failed = True
+                break
+            if chunk is None:
+                break
+            messages.extend(chunk)
+            tasks.append(asyncio.create_task(
+                draft_chunk(service, chunk, sem, conversations, drafted_ids)
+            ))
+        results = [r for chunk_results in await asyncio.gather(*tasks) for r in chunk_results]
+    finally:
+        save_conversations(conversations)
+        # Mark drafted messages read even if the run stops early, so the next
+        # run does not draft them again
+        try:
+            await run_gmail(mark_read, service, drafted_ids)
+        except Exception as e:
+            logging.warning('Could not mark messages read: %s', e)
 
     total       = len(messages)
-    drafted     = 0
-    skipped     = 0
-    errors      = 0
 
-    if not messages:
+    if not messages and not list_failed:
         logging.info('No new messages found.')
         update_last_run_time()
         return
 
-    for msg in messages:
-        msg_id = msg['id']
-        try:
-            subj, sender, body, thread_id = get_message_content(service, msg_id)
-            if not body.strip():
-                logging.warning('Skipped empty message %s', msg_id)
-                skipped += 1
-                continue
-
-            logging.info('Drafting reply for %s (from %s)', subj, sender)
-            reply = generate_reply_from_openai(body)
-            draft_reply(service, thread_id, sender, subj, reply)
-            logging.info('Draft created for %s', msg_id)
-            drafted += 1
-
-            # Mark read
-            try:
-                service.users().messages().modify(
-                    userId='me', id=msg_id,
-                    body={'removeLabelIds': ['UNREAD']}
-                ).execute()
-            except Exception as e:
-                logging.warning('Could not mark read %s: %s', msg_id, e)
-
-        except Exception as e:
-            logging.error('Error on %s: %s', msg_id, e)
-            errors += 1
+    drafted     = results.count(1)
+    skipped     = results.count(0)
+    unfetched   = results.count(-2)
+    errors      = results.count(-1) + unfetched
 
-    # Always update last_run
-    update_last_run_time()
+    # Leave last_run alone if listing stopped early or any message could not
+    # be fetched, so the next run's after: query still finds the rest
+    # (drafted mail is already marked read)
+    if list_failed:
+        logging.warning('Listing stopped early; last run time not updated')
+    elif unfetched:
+        logging.warning('%d messages could not be fetched; last run time not updated', unfetched)
+    else:
+        update_last_run_time()
     logging.info(
         'Run complete: %d total, %d drafted, %d skipped, %d errors',
         total, drafted, skipped, errors
     )
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
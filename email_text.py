@@ -0,0 +1,106 @@
+"""Helpers shared by the Gmail scripts for turning message bodies into text."""
+import re
+import base64
+import codecs
+from selectolax.lexbor import LexborHTMLParser
+
+MIME_PLAIN      = 'text/plain'
+MIME_HTML       = 'text/html'
+BODY_MIME_TYPES = frozenset((MIME_PLAIN, MIME_HTML))
+# Gmail fields= mask for a payload, down to three levels of nested multipart
+# (e.g. mixed > related > alternative); headers carry each part's charset
+PART_FIELDS     = (
+    'mimeType,headers(name,value),body/data,'
+    'parts(mimeType,headers(name,value),body/data,'
+    'parts(mimeType,headers(name,value),body/data,'
+    'parts(mimeType,headers(name,value),body/data)))'
+)
+_CHARSET_RE     = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+# Mail labelled Latin-1 is routinely cp1252, and 8-bit "ASCII" is usually UTF-8
+_CHARSET_ALIASES = {
+    'iso-8859-1': 'cp1252', 'latin-1': 'cp1252', 'latin1': 'cp1252',
+    'us-ascii': 'utf-8', 'ascii': 'utf-8'
+}
+
+# Elements that start a new line when rendered; everything else is inline
+BLOCK_TAGS = (
+    'address', 'article', 'aside', 'blockquote', 'dd', 'div', 'dl', 'dt',
+    'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol',
+    'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul'
+)
+_BLOCK_SELECTOR = ', '.join(BLOCK_TAGS)
+_BREAK          = '\ue000'  # private-use marker for block and <br> boundaries
+_SPACE_RE       = re.compile(r'\s+')  # never matches _BREAK
+_BLANK_RE       = re.compile(r'\n{3,}')
+
+def html_to_text(html):
+    """
+    Convert an HTML body to plain text, dropping the head, scripts and styles.
+    Whitespace is collapsed as a browser would; line breaks are kept only at
+    <br> and block element boundaries.
+    """
+    tree = LexborHTMLParser(html)
+    tree.strip_tags(['head', 'script', 'style'])
+    for node in tree.css('br'):
+        node.insert_after(_BREAK)
+    for node in tree.css(_BLOCK_SELECTOR):
+        node.insert_before(_BREAK)
+        node.insert_after(_BREAK)
+    root = tree.body or tree.root
+    if root is None:
+        return ''
+    text = _SPACE_RE.sub(' ', root.text(separator='', strip=False))
+    lines = (line.strip() for line in text.split(_BREAK))
+    return _BLANK_RE.sub('\n\n', '\n'.join(lines)).strip()
+
+def iter_parts(payload):
+    """Yield `payload` and all of its nested MIME parts, depth-first in order."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get('parts') or []))
+
+def part_charset(part):
+    """Return the charset declared in a part's Content-Type header, or None."""
+    for h in part.get('headers') or []:
+        if h['name'].lower() == 'content-type':
+            match = _CHARSET_RE.search(h['value'])
+            return match.group(1).lower() if match else None
+    return None
+
+def decode_part(part):
+    """
+    Decode a part's body data to text using its declared charset, falling
+    back to UTF-8 when none is declared or it is unknown.
+    """
+    data = base64.urlsafe_b64decode(part['body']['data'])
+    charset = part_charset(part)
+    charset = _CHARSET_ALIASES.get(charset, charset) or 'utf-8'
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = 'utf-8'
+    return data.decode(charset, errors='replace')
+
+def extract_body(payload):
+    """
+    Return the text of a message payload: the first text/plain part, else the
+    first text/html part converted to text, else the payload's own body.
+    """
+    # One pass over the MIME tree, keeping the first plain text and HTML parts
+    found = {}
+    for part in iter_parts(payload):
+        mime = part.get('mimeType')
+        if mime in BODY_MIME_TYPES and part.get('body', {}).get('data'):
+            found.setdefault(mime, part)
+
+    if MIME_PLAIN in found:
+        return decode_part(found[MIME_PLAIN])
+    if MIME_HTML in found:
+        return html_to_text(decode_part(found[MIME_HTML]))
+
+    # Single-part message fallback
+    if payload.get('body', {}).get('data'):
+        return decode_part(payload)
+    return ''
@@ -0,0 +1,158 @@
+"""Gmail transport, worker threads and batch fetching shared by both scripts."""
+import time
+import random
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import httpx
+import httplib2
+import google_auth_httplib2
+import orjson
+from google.auth.exceptions import TransportError
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
+
+# Google advises at most 50 calls per batch; each messages.get costs 5 quota
+# units against a per-user limit of about 250 units per second
+BATCH_SIZE        = 50
+FETCH_CONCURRENCY = 2  # batch fetches in flight at once
+FETCH_ATTEMPTS    = 5
+RETRY_BASE_DELAY  = 1.0  # seconds, doubled after each attempt
+RETRY_MAX_DELAY   = 30.0
+GMAIL_TIMEOUT     = 60.0  # seconds
+GMAIL_WORKERS     = 15  # roughly Gmail's per-user concurrent request limit
+GMAIL_CONNECTIONS = 50  # pooled HTTP/2 connections to Gmail
+
+# Network-level failures, always worth another attempt
+TRANSPORT_ERRORS  = (httpx.HTTPError, httplib2.HttpLib2Error, TransportError, OSError)
+
+logger = logging.getLogger(__name__)
+
+# Blocking Gmail calls run here, off the event loop. Batch fetches get their
+# own small pool so only FETCH_CONCURRENCY of them hit Gmail at once.
+_gmail_pool = ThreadPoolExecutor(max_workers=GMAIL_WORKERS)
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY)
+
+class OrjsonModel(JsonModel):
+    """JsonModel that parses Gmail API responses with orjson."""
+
+    def deserialize(self, content):
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return content
+
+class HttpxHttp:
+    """Minimal httplib2.Http stand-in that sends requests over HTTP/2 with httpx."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        resp = self.client.request(method, uri, content=body, headers=headers)
+        info = dict(resp.headers)
+        info['status'] = resp.status_code
+        return httplib2.Response(info), resp.content
+
+    def close(self):
+        self.client.close()
+
+def build_service(creds):
+    """Return a Gmail API service for `creds` that talks HTTP/2 via httpx."""
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=HttpxHttp(httpx.Client(
+        http2=True, follow_redirects=True, timeout=GMAIL_TIMEOUT,
+        limits=httpx.Limits(max_connections=GMAIL_CONNECTIONS)
+    )))
+    return build(
+        'gmail', 'v1', http=http, model=OrjsonModel(),
+        cache_discovery=False, static_discovery=True
+    )
+
+async def run_gmail(fn, *args, fetch=False):
+    """
+    Run a blocking Gmail call on a Gmail worker thread and await it. Pass
+    fetch=True for batch fetches, which run on the smaller fetch pool.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _fetch_pool if fetch else _gmail_pool
+    return await loop.run_in_executor(pool, functools.partial(fn, *args))
+
+def chunked(iterable, size):
+    """Yield successive lists of at most `size` items from `iterable`."""
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def is_retryable(exc):
+    """
+    Return True for rate-limit, server and transport errors from Gmail. Other
+    HTTP errors and anything raised while parsing a response are permanent.
+    """
+    if isinstance(exc, TRANSPORT_ERRORS):
+        return True
+    if not isinstance(exc, HttpError):
+        return False
+    status = exc.resp.status
+    if status == 429 or status >= 500:
+        return True
+    return status == 403 and b'ratelimitexceeded' in (exc.content or b'').lower()
+
+def fetch_messages(service, msg_ids, fields, parse):
+    """
+    Fetch messages with Gmail batch requests of up to BATCH_SIZE calls and
+    run `parse` on each response. Calls rejected for rate limits or server
+    errors are re-batched with exponential backoff, up to FETCH_ATTEMPTS
+    times in all.
+    Returns a dict mapping each msg_id to its parsed result, or to the
+    exception raised while fetching or parsing that message; is_retryable()
+    is True for those that were still failing transiently after the retries.
+    """
+    results = {}
+    pending = list(msg_ids)
+    for attempt in range(FETCH_ATTEMPTS):
+        if attempt:
+            delay = min(RETRY_BASE_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+            logger.warning('Retrying %d Gmail fetches in %.0fs', len(pending), delay)
+            time.sleep(delay + random.uniform(0, delay / 2))
+        retry = []
+
+        def on_msg(request_id, response, exception):
+            if exception is not None:
+                results[request_id] = exception
+                if is_retryable(exception):
+                    retry.append(request_id)
+                return
+            try:
+                results[request_id] = parse(response)
+            except Exception as e:
+                results[request_id] = e
+
+        for chunk in chunked(pending, BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=on_msg)
+            for msg_id in chunk:
+                batch.add(
+                    service.users().messages().get(
+                        userId='me', id=msg_id, format='full', fields=fields
+                    ),
+                    request_id=msg_id
+                )
+            try:
+                batch.execute()
+            except Exception as e:
+                # The whole batch failed, so none of its callbacks ran
+                for msg_id in chunk:
+                    results[msg_id] = e
+                if is_retryable(e):
+                    retry.extend(chunk)
+
+        if not retry:
+            break
+        pending = retry
+    return results
@@ -1,26 +1,43 @@
 #!/usr/bin/env python3
 import os
-import base64
-import tempfile
+import asyncio
 import logging
+import functools
 from dotenv import load_dotenv
-import openai
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from gmail_batch import (
+    BATCH_SIZE, build_service, chunked, fetch_messages, is_retryable, run_gmail
+)
+from email_text import PART_FIELDS, extract_body
 
 # ─── CONFIGURATION ─────────────────────────────────────────────────────────────
 load_dotenv()
-OPENAI_API_KEY   = os.getenv('OPENAI_API_KEY')
-VECTOR_STORE_ID  = os.getenv('VECTOR_STORE_ID')
-GMAIL_LABEL      = os.getenv('GMAIL_LABEL_ID')
-SIGNATURE_MARKER = os.getenv('SIGNATURE_MARKER', '--')
-CREDENTIALS_PATH = os.getenv('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
-REDIRECT_URI     = os.getenv('REDIRECT_URI', 'http://localhost:8888/')
-SCOPES           = ['https://www.googleapis.com/auth/gmail.modify']
+OPENAI_API_KEY          = os.getenv('OPENAI_API_KEY')
+VECTOR_STORE_ID         = os.getenv('VECTOR_STORE_ID')
+GMAIL_LABEL             = os.getenv('GMAIL_LABEL_ID')
+SIGNATURE_MARKER        = os.getenv('SIGNATURE_MARKER', '--')
+CREDENTIALS_PATH        = os.getenv('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
+REDIRECT_URI            = os.getenv('REDIRECT_URI', 'http://localhost:8888/')
+SCOPES                  = ['https://www.googleapis.com/auth/gmail.modify']
+LIST_PAGE_SIZE          = 500  # Gmail's maximum page size for messages.list
+MODIFY_BATCH_SIZE       = 1000  # messages.batchModify accepts up to 1000 IDs
+VECTOR_STORE_BATCH_SIZE = 500  # vector store file batches accept up to 500 IDs
+# Partial response: only the parts of the message resource we actually read
+MESSAGE_FIELDS          = f'payload({PART_FIELDS})'
+OPENAI_CONCURRENCY      = int(os.getenv('OPENAI_CONCURRENCY', '20'))
+HTTP_MAX_CONNECTIONS    = 50  # pooled HTTP/2 connections to OpenAI
 
-openai.api_key = OPENAI_API_KEY
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=DefaultAsyncHttpxClient(
+        http2=True, limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS)
+    )
+)
 
 # ─── LOGGING SETUP ──────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -31,11 +48,17 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ─── HELPERS ────────────────────────────────────────────────────────────────────
+@functools.lru_cache(maxsize=1)
 def get_service():
     """Authenticate to Gmail and return a service object."""
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        # Refresh up front rather than on the first API call
+        if creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+            with open('token.json', 'w') as f:
+                f.write(creds.to_json())
     else:
         flow = InstalledAppFlow.from_client_secrets_file(
             CREDENTIALS_PATH, SCOPES, redirect_uri=REDIRECT_URI
@@ -47,136 +70,206 @@ def get_service():
         creds = flow.credentials
         with open('token.json', 'w') as f:
             f.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    return build_service(creds)
 
 def get_labeled_messages(service):
-    """Return all messages with the configured label, handling pagination."""
-    messages = []
+    """Yield messages with the configured label as each page arrives."""
     try:
         request = service.users().messages().list(
-            userId='me', labelIds=[GMAIL_LABEL]
+            userId='me', labelIds=[GMAIL_LABEL], maxResults=LIST_PAGE_SIZE
         )
         while request:
             response = request.execute()
-            messages.extend(response.get('messages', []))
+            yield from response.get('messages', [])
             request = service.users().messages().list_next(request, response)
-    except HttpError as e:
+    except (HttpError, httpx.HTTPError) as e:
         logger.error('Failed to list labeled messages: %s', e)
-    return messages
+
+def parse_body(msg):
+    """Return the text body of a full message resource."""
+    return extract_body(msg.get('payload', {}))
+
+def get_message_bodies(service, messages):
+    """
+    Fetch full messages via gmail_batch.fetch_messages.
+    Returns a dict mapping each msg_id to its body, or to the exception raised
+    while fetching or parsing that message.
+    """
+    return fetch_messages(
+        service, [msg['id'] for msg in messages], MESSAGE_FIELDS, parse_body
+    )
+
+def remove_label(service, msg_ids):
+    """Remove the configured label from the given messages via batchModify."""
+    for chunk in chunked(msg_ids, MODIFY_BATCH_SIZE):
+        service.users().messages().batchModify(
+            userId='me', body={'ids': chunk, 'removeLabelIds': [GMAIL_LABEL]}
+        ).execute()
+        logger.info('Removed label from %d messages', len(chunk))
 
 def strip_signature(body):
-    """Remove everything after the signature marker."""
-    return body.split(SIGNATURE_MARKER)[0].strip()
+    """Remove everything after the signature marker at the start of a line."""
+    if body.startswith(SIGNATURE_MARKER):
+        return ''
+    return body.partition('\n' + SIGNATURE_MARKER)[0].strip()
 
-def upload_to_openai_file(filepath):
-    """Upload a temp file to OpenAI and return its file ID."""
-    with open(filepath, 'rb') as f:
-        resp = openai.files.create(file=f, purpose='assistants')
+async def upload_to_openai_file(filename, data):
+    """Upload in-memory bytes to OpenAI as `filename` and return its file ID."""
+    resp = await client.files.create(file=(filename, data), purpose='assistants')
     return resp.id
 
-def add_to_vector_store(file_id):
-    """Add an uploaded file to the configured vector store."""
-    openai.vector_stores.files.create(
-        vector_store_id=VECTOR_STORE_ID, file_id=file_id
+async def attach_file_batch(file_ids):
+    """
+    Attach up to VECTOR_STORE_BATCH_SIZE files to the vector store in one file
+    batch and wait for indexing. Returns the number of files indexed.
+    """
+    batch = await client.vector_stores.file_batches.create_and_poll(
+        vector_store_id=VECTOR_STORE_ID, file_ids=file_ids
+    )
+    logger.info(
+        'Indexed %d of %d files (batch %s, status %s)',
+        batch.file_counts.completed, len(file_ids), batch.id, batch.status
     )
+    return batch.file_counts.completed
+
+async def add_to_vector_store(file_ids):
+    """
+    Attach uploaded files to the configured vector store, one file batch per
+    VECTOR_STORE_BATCH_SIZE files, polled concurrently. A failed batch is
+    logged and counts as zero files indexed without affecting the others.
+    Returns the number of files indexed.
+    """
+    chunks = list(chunked(file_ids, VECTOR_STORE_BATCH_SIZE))
+    counts = await asyncio.gather(
+        *(attach_file_batch(chunk) for chunk in chunks), return_exceptions=True
+    )
+    indexed = 0
+    for chunk, count in zip(chunks, counts):
+        if isinstance(count, Exception):
+            logger.error('Failed to attach %d files to vector store: %s', len(chunk), count)
+        else:
+            indexed += count
+    return indexed
 
 # ─── PROCESSING ────────────────────────────────────────────────────────────────
-def process_message(service, msg_id):
+async def process_message(msg_id, body, sem):
     """
-    Process a single Gmail message:
-    - Fetch body (plain text or HTML)
+    Process a single fetched Gmail message:
     - Strip signature
-    - Upload to OpenAI and index
-    - Always remove the Gmail label
-    Returns:
-      1 if successfully processed,
+    - Upload to OpenAI
+    `body` is the extracted message body, or the exception raised fetching it.
+    At most `sem` uploads are in flight at once.
+    Returns (result, file_id) where result is:
+      1 if successfully uploaded,
       0 if skipped (empty body),
-     -1 on error.
+     -1 on error,
+     -2 if fetching the message kept failing with a transient error.
     """
+    if isinstance(body, Exception) and is_retryable(body):
+        logger.error('Could not fetch %s, will retry next run: %s', msg_id, body)
+        return -2, None
     try:
-        # Fetch the full message
-        msg = service.users().messages().get(
-            userId='me', id=msg_id, format='full'
-        ).execute()
-        payload = msg.get('payload', {})
-        body = ''
-
-        # Try plain text part
-        for part in payload.get('parts', []):
-            if part.get('mimeType') == 'text/plain' and part.get('body', {}).get('data'):
-                body = base64.urlsafe_b64decode(part['body']['data']).decode()
-                break
-
-        # Fallback to HTML if no plain text
-        if not body:
-            for part in payload.get('parts', []):
-                if part.get('mimeType') == 'text/html' and part.get('body', {}).get('data'):
-                    html = base64.urlsafe_b64decode(part['body']['data']).decode()
-                    body = html.replace('<br>', '\n').replace('<br/>', '\n')
-                    break
-
-        # Single-part message fallback
-        if not body and payload.get('body', {}).get('data'):
-            body = base64.urlsafe_b64decode(payload['body']['data']).decode()
-
+        if body is None:
+            raise RuntimeError('message was not fetched')
+        if isinstance(body, Exception):
+            raise body
         if not body.strip():
             logger.warning('Skipped empty message %s', msg_id)
-            return 0
+            return 0, None
 
         cleaned = strip_signature(body)
 
-        # Write to temp file and upload/index
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.txt') as tmp:
-            tmp.write(cleaned)
-            tmp.flush()
-            logger.info('Uploading message %s to OpenAI...', msg_id)
-            file_id = upload_to_openai_file(tmp.name)
-            logger.info('Uploaded file ID %s', file_id)
-
-        logger.info('Attaching file to vector store: %s', VECTOR_STORE_ID)
-        add_to_vector_store(file_id)
-        logger.info('Indexed message %s successfully', msg_id)
-        return 1
+        logger.info('Uploading message %s to OpenAI...', msg_id)
+        async with sem:
+            file_id = await upload_to_openai_file(
+                f'{msg_id}.txt', cleaned.encode('utf-8')
+            )
+        logger.info('Uploaded file ID %s', file_id)
+        return 1, file_id
 
     except Exception as e:
         logger.error('Error processing message %s: %s', msg_id, e)
-        return -1
+        return -1, None
 
-    finally:
-        # Always remove the label, even on errors or skips
-        try:
-            service.users().messages().modify(
-                userId='me', id=msg_id,
-                body={'removeLabelIds': [GMAIL_LABEL]}
-            ).execute()
-            logger.info('Removed label from message %s', msg_id)
-        except Exception as exc:
-            logger.warning('Failed to remove label from %s: %s', msg_id, exc)
+async def upload_chunk(service, chunk, sem):
+    """
+    Batch-fetch a chunk of messages and upload their bodies concurrently.
+    Returns (msg_id, result, file_id) for each message, in chunk order.
+    """
+    try:
+        bodies = await run_gmail(get_message_bodies, service, chunk, fetch=True)
+    except Exception as e:
+        logger.error('Gmail batch fetch error: %s', e)
+        bodies = {}
+    results = await asyncio.gather(*(
+        process_message(msg['id'], bodies.get(msg['id']), sem)
+        for msg in chunk
+    ))
+    return [
+        (msg['id'], result, file_id)
+        for msg, (result, file_id) in zip(chunk, results)
+    ]
 
-def main():
+async def main():
     service = get_service()
-    messages = get_labeled_messages(service)
+    sem = asyncio.Semaphore(OPENAI_CONCURRENCY)
 
-    total = len(messages)
-    processed = skipped = errors = 0
+    # Pipeline: fetch and upload each chunk while later pages load
+    chunks = chunked(get_labeled_messages(service), BATCH_SIZE)
+    messages = []
+    tasks = []
+    # Messages with a final outcome; only these lose the label. Messages whose
+    # fetch kept failing transiently keep it and are retried on the next run.
+    settled = []
+    processed = skipped = errors = unfetched = 0
+
+    try:
+        while True:
+            chunk = await run_gmail(next, chunks, None)
+            if chunk is None:
+                break
+            messages.extend(chunk)
+            tasks.append(asyncio.create_task(upload_chunk(service, chunk, sem)))
 
-    if total == 0:
-        logger.info('No messages found with label %s', GMAIL_LABEL)
-        return
+        if not messages:
+            logger.info('No messages found with label %s', GMAIL_LABEL)
+            return
 
-    for msg in messages:
-        result = process_message(service, msg['id'])
-        if result == 1:
-            processed += 1
-        elif result == 0:
-            skipped += 1
-        else:
-            errors += 1
+        results = [r for chunk_results in await asyncio.gather(*tasks) for r in chunk_results]
+        skipped = sum(1 for _, result, _ in results if result == 0)
+        errors = sum(1 for _, result, _ in results if result == -1)
+        unfetched = sum(1 for _, result, _ in results if result == -2)
+        settled.extend(msg_id for msg_id, result, _ in results if result in (0, -1))
+        uploaded = [(msg_id, file_id) for msg_id, result, file_id in results if result == 1]
+        file_ids = [file_id for _, file_id in uploaded]
+
+        if file_ids:
+            logger.info(
+                'Attaching %d files to vector store: %s', len(file_ids), VECTOR_STORE_ID
+            )
+            try:
+                processed = await add_to_vector_store(file_ids)
+                errors += len(file_ids) - processed
+            except Exception as e:
+                logger.error('Failed to attach files to vector store: %s', e)
+                errors += len(file_ids)
+            settled.extend(msg_id for msg_id, _ in uploaded)
 
+    finally:
+        # Remove the label from settled messages, even on errors or skips
+        try:
+            await run_gmail(remove_label, service, settled)
+        except Exception as exc:
+            logger.warning('Failed to remove labels: %s', exc)
+
+    if unfetched:
+        logger.warning(
+            '%d messages could not be fetched and keep label %s', unfetched, GMAIL_LABEL
+        )
     logger.info(
         'Run complete: total=%d, processed=%d, skipped=%d, errors=%d',
-        total, processed, skipped, errors
+        len(messages), processed, skipped, errors + unfetched
     )
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())